@@ -0,0 +1,213 @@
+import asyncio
+import functools
+import os
+import re
+import shlex
+import shutil
+import signal
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from app.settings import settings
+
+# ===== 実行制御用の設定 =====
+CMD_TIMEOUT = settings.cmd_timeout  # コマンドの最大実行時間（秒）
+MAX_BYTES = settings.max_bytes      # 標準出力・標準エラーの最大バイト数
+_READ_CHUNK = 64 * 1024             # パイプから一度に読むバイト数
+_OMITTED = "\n[...省略しました...]"  # 切り詰めたときに末尾に付ける印
+
+
+def _truncate(s: Optional[str], limit: int) -> str:
+    """UTF-8 バイト数で安全に切り詰める"""
+    if s is None:
+        return ""
+    # UTF-8 は1文字最大4バイトなので、短い文字列はエンコードせずに判定できる
+    if len(s) <= limit // 4:
+        return s
+    b = s.encode("utf-8")
+    if len(b) <= limit:
+        return s
+    # memoryview でスライスしてコピーを作らずにデコードする
+    return str(memoryview(b)[:limit], "utf-8", errors="ignore") + _OMITTED
+
+
+# これらの文字を含むコマンドはパイプ・リダイレクト・変数展開などシェルの機能が必要
+_SHELL_CHARS = frozenset("|&;<>()$`\\\"'*?[]{}#~=%\n")
+
+
+def _needs_shell(command: str) -> bool:
+    """/bin/sh を経由して実行する必要があるコマンドか判定"""
+    return not _SHELL_CHARS.isdisjoint(command)
+
+
+@functools.lru_cache(maxsize=256)
+def _which(name: str, path: Optional[str]) -> str:
+    """
+    実行ファイルの絶対パスを PATH ごとにキャッシュする。
+    exec のたびに PATH の各ディレクトリを順に試す execve を省ける。
+    見つからなければ name をそのまま返す（呼び出し側でシェルにフォールバック）。
+    argv[0] を保つ subprocess.Popen（RQ ワーカー側）でだけ使う。
+    """
+    if os.sep in name:
+        return name
+    return shutil.which(name, path=path) or name
+
+
+async def _spawn(command: str, cwd: Path) -> asyncio.subprocess.Process:
+    """
+    サブプロセスを起動する。
+    - シェルの機能が不要なコマンド（ls, pwd, echo など）は直接 exec し、/bin/sh の起動を省く
+    - それ以外とシェル組み込みコマンド（exit, type など）は従来どおりシェル経由
+    """
+    # 新しいセッション（プロセスグループ）で起動し、タイムアウト時に孫プロセスごと kill できるようにする
+    pipes = dict(
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=str(cwd),
+        start_new_session=True,
+    )
+    if not _needs_shell(command):
+        argv = shlex.split(command)
+        try:
+            # executable= は渡さない（uvloop は argv[0] をそのパスに置き換えるため、
+            # エラーメッセージが "ls: ..." ではなく "/usr/bin/ls: ..." になってしまう）
+            return await asyncio.create_subprocess_exec(*argv, **pipes)
+        except (FileNotFoundError, PermissionError):
+            pass
+    return await asyncio.create_subprocess_shell(command, **pipes)
+
+
+def _kill_group(pid: int) -> None:
+    """start_new_session=True で起動したプロセスをグループごと SIGKILL する"""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _append_capped(buf: bytearray, chunk: bytes, limit: int) -> bool:
+    """chunk のうち buf が limit バイトに収まる分だけ追記し、はみ出した分があれば True を返す"""
+    room = limit - len(buf)
+    if len(chunk) > room:
+        buf += chunk[:max(room, 0)]
+        return True
+    buf += chunk
+    return False
+
+
+async def _read_capped(stream: asyncio.StreamReader, limit: int) -> Tuple[bytearray, bool]:
+    """
+    ストリームを最後まで読み、先頭 limit バイトだけを保持する。
+    - 戻り値は (保持したバイト列, limit を超えて切り捨てたか)
+    - 残りは読み捨てて、子プロセスがパイプ詰まりで止まらないようにする
+    - 1つの bytearray に追記するので、チャンクのリストや join 後の bytes を作らない
+    """
+    buf = bytearray()
+    truncated = False
+    while True:
+        chunk = await stream.read(_READ_CHUNK)
+        if not chunk:
+            break
+        truncated |= _append_capped(buf, chunk, limit)
+    return buf, truncated
+
+
+def _decode_output(captured: Tuple[bytearray, bool], strip: bool = True) -> str:
+    """
+    読み取った出力を文字列にし、（strip なら前後の空白を除いて）MAX_BYTES に切り詰める。
+    読み取りの時点で切り捨てていれば、strip 後の長さに関係なく「省略しました」を付ける。
+    """
+    buf, truncated = captured
+    text = buf.decode("utf-8", errors="replace")
+    if strip:
+        text = text.strip()
+    text = _truncate(text, MAX_BYTES)
+    if truncated and not text.endswith(_OMITTED):
+        text += _OMITTED
+    return text
+
+
+async def _run(command: str, cwd: Path) -> Tuple[int, str, str]:
+    """
+    コマンドを非同期のサブプロセスで実行する。
+    - イベントループをブロックしないので複数リクエストを並行して処理できる
+    - 出力は MAX_BYTES 程度までしかメモリに保持せず、前後の空白を除いて切り詰めて返す
+    - CMD_TIMEOUT を超えたらプロセスを kill して asyncio.TimeoutError を送出
+    - 呼び出し側がキャンセルされた場合もプロセスを kill してから CancelledError を送出
+    """
+    proc = await _spawn(command, cwd)
+    try:
+        stdout, stderr, _ = await asyncio.wait_for(
+            asyncio.gather(
+                _read_capped(proc.stdout, MAX_BYTES),
+                _read_capped(proc.stderr, MAX_BYTES),
+                proc.wait(),
+            ),
+            timeout=CMD_TIMEOUT,
+        )
+    except BaseException:
+        # タイムアウトのほか、シャットダウン時などのキャンセルでも
+        # シェルが起動した孫プロセスが残らないようにグループごと kill してから回収する
+        _kill_group(proc.pid)
+        await proc.wait()
+        raise
+
+    return proc.returncode, _decode_output(stdout), _decode_output(stderr)
+
+
+# ===== 結果キャッシュ =====
+# 副作用がなく、同じディレクトリなら同じ結果になるコマンドは短時間キャッシュして
+# プリセットの連打などでサブプロセスを起動しないようにする
+# Redis で共有しないのは、hostname や uname -a の結果がレプリカごとに違うため
+_CACHE_TTL = settings.cmd_cache_ttl        # キャッシュの有効期間（秒）、0 で無効
+_CACHE_MAXSIZE = settings.cmd_cache_size   # キャッシュする最大件数、0 で無効
+# 許可リストのコマンドと、シェルの機能を使わない echo を1回の走査で判定する
+_CACHEABLE_RE = re.compile(
+    r"pwd|uname -a|whoami|id|hostname"
+    r"|echo [^" + re.escape("".join(sorted(_SHELL_CHARS))) + r"]*"
+)
+# shlex.split が区切りとして扱う空白（\n はシェル経由になるのでキャッシュ対象外）
+_BLANKS_RE = re.compile(r"[ \t\r]+")
+
+# (コマンド, 作業ディレクトリ) -> (有効期限, 実行結果)
+_cache: Dict[Tuple[str, str], Tuple[float, Tuple[int, str, str]]] = {}
+
+
+def _is_cacheable(command: str) -> bool:
+    """結果をキャッシュしてよいコマンドか判定"""
+    return _CACHEABLE_RE.fullmatch(command) is not None
+
+
+def _cache_put(key: Tuple[str, str], value: Tuple[int, str, str], now: float) -> None:
+    if len(_cache) >= _CACHE_MAXSIZE:
+        # 期限切れを掃除し、それでも満杯なら一番古いものを捨てる
+        for k in [k for k, (expires, _) in _cache.items() if expires <= now]:
+            del _cache[k]
+        if len(_cache) >= _CACHE_MAXSIZE:
+            del _cache[next(iter(_cache))]
+    _cache[key] = (now + _CACHE_TTL, value)
+
+
+async def run_shell(command: str, cwd: Path) -> Tuple[int, str, str]:
+    """
+    コマンドを実行して (終了コード, 標準出力, 標準エラー) を返す。
+    キャッシュ可能なコマンドは _CACHE_TTL 秒以内の同じ呼び出しに前回の結果を返す。
+    キャッシュには切り詰め済みの文字列を入れるので、ヒット時は _truncate も不要。
+    """
+    # 空白の入れ方だけが違うコマンドは同じキーにする
+    # （キャッシュ対象はシェルを通さず shlex.split で分割するので結果も同じ）
+    # str.split() だと全角スペースなども区切りになるので、shlex と同じ ASCII 空白だけを詰める
+    normalized = _BLANKS_RE.sub(" ", command).strip(" ")
+    if _CACHE_TTL <= 0 or _CACHE_MAXSIZE <= 0 or not _is_cacheable(normalized):
+        return await _run(command, cwd)
+
+    key = (normalized, str(cwd))
+    now = time.monotonic()
+    hit = _cache.get(key)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+
+    result = await _run(command, cwd)
+    _cache_put(key, result, time.monotonic())
+    return result
@@ -1,68 +1,157 @@
-from fastapi import FastAPI, Body
-import subprocess
+from fastapi import FastAPI, Body, Header, Request
+from fastapi.openapi.docs import (
+    get_redoc_html,
+    get_swagger_ui_html,
+    get_swagger_ui_oauth2_redirect_html,
+)
+from fastapi.responses import ORJSONResponse, Response
+import asyncio
+import hashlib
+import os
+import re
+import stat
 from pathlib import Path
-from threading import Lock
-from typing import Optional
+from typing import Callable, Dict, Optional, Tuple
+ 
+import orjson
+from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
  
-# ===== 実行制御用の設定 =====
-CMD_TIMEOUT = 5          # コマンドの最大実行時間（秒）
-MAX_BYTES = 200_000      # 標準出力・標準エラーの最大バイト数
+from app import tasks
+from app._common import CMD_TIMEOUT, _needs_shell, run_shell
+from app.redis_client import get_async_redis, get_redis
+from app.settings import settings
  
  
 # ===== 作業用ディレクトリの設定 =====
 BASE_DIR = Path("/tmp/commandtest_workspace")
 BASE_DIR.mkdir(exist_ok=True)
  
+# 範囲チェック用に文字列を先に作っておく（Path.parents をたどらずに済む）
+_BASE_STR = str(BASE_DIR)
+_BASE_PREFIX = _BASE_STR + os.sep
+ 
 # 現在の作業ディレクトリ（初期値は BASE_DIR）
+# 参照の代入は CPython ではアトミックなのでロックは使わない
 _current_dir = BASE_DIR
-_dir_lock = Lock()
+ 
+# セッションIDごとの作業ディレクトリは Redis に保存する（複数人・複数レプリカ向け）
+# 接続は最初にセッションIDが使われたときに張られる
+_redis = get_async_redis()
+ 
+ 
+def _session_key(session_id: str) -> str:
+    return f"commandtest:{session_id}:cwd"
  
  
-def get_current_dir() -> Path:
-    """スレッドセーフに現在ディレクトリを取得"""
-    with _dir_lock:
+async def get_current_dir(session_id: Optional[str] = None) -> Path:
+    """
+    現在ディレクトリを取得。
+    - セッションIDがなければプロセス共通のディレクトリ
+    - セッションIDがあれば Redis に保存したディレクトリ（未設定なら BASE_DIR）
+    """
+    if session_id is None:
         return _current_dir
+    # 読み出しと有効期限の延長を1往復で済ませる（使われている間はセッションが消えない）
+    key = _session_key(session_id)
+    async with _redis.pipeline(transaction=False) as pipe:
+        pipe.get(key)
+        pipe.expire(key, settings.session_ttl)
+        value, _ = await pipe.execute()
+    return Path(value) if value else BASE_DIR
+ 
  
+async def _set_current_dir(new_dir: Path, session_id: Optional[str]) -> None:
+    global _current_dir
+    if session_id is None:
+        _current_dir = new_dir
+    else:
+        # 放置されたセッションは session_ttl 秒で自動的に消える
+        await _redis.set(_session_key(session_id), str(new_dir), ex=settings.session_ttl)
  
-def change_dir(target: str) -> str:
+ 
+def _probe(current: Path, target: str) -> Tuple[Path, bool, bool]:
+    """
+    移動先のパスを解決し、(パス, 存在するか, ディレクトリか) を返す。
+    - パスは文字列として正規化し、BASE_DIR より下の要素だけを lstat する
+      （resolve() は / からすべての要素を調べる）
+    - 移動後に削除・置き換えされることもあるので、current 側の要素も毎回確認する
+    - シンボリックリンクを含む場合だけ resolve() で実体を求める
+    ファイルシステムへのアクセスはここにまとめ、スレッドで実行する。
+    """
+    if target in ("", "~"):
+        path = _BASE_STR
+    else:
+        # 相対パス扱い（ただし絶対パスを渡されても normpath で正規化）
+        path = os.path.normpath(os.path.join(current, target))
+ 
+    # BASE_DIR より上は固定なので、そこから下だけ調べる
+    if path == _BASE_STR or path.startswith(_BASE_PREFIX):
+        walked = _BASE_STR
+    else:
+        walked = os.path.commonpath([current, path])
+    parts = Path(path).relative_to(walked).parts
+    for part in parts:
+        walked = os.path.join(walked, part)
+        try:
+            st = os.lstat(walked)
+        except (FileNotFoundError, NotADirectoryError):
+            return Path(path), False, False
+        if stat.S_ISLNK(st.st_mode):
+            new_dir = (current / target).resolve()
+            return new_dir, new_dir.exists(), new_dir.is_dir()
+        if not stat.S_ISDIR(st.st_mode):
+            return Path(path), walked == path, False
+    if parts:
+        return Path(path), True, True
+ 
+    # 辿る要素がない場合（BASE_DIR 自身やその外の祖先）も最後に存在を確かめる
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return Path(path), False, False
+    return Path(path), True, stat.S_ISDIR(st.st_mode)
+ 
+ 
+async def change_dir(target: str, session_id: Optional[str] = None) -> str:
     """
     cd コマンド用。
     - 相対パス/絶対パスどちらもOK
     - BASE_DIR の外には出られないように制限
     """
-    global _current_dir
-    with _dir_lock:
-        if target in ("", "~"):
-            new_dir = BASE_DIR
-        else:
-            # 相対パス扱い（ただし絶対パスを渡されても resolve で正規化）
-            new_dir = (_current_dir / target).resolve()
+    current = await get_current_dir(session_id)
+    new_dir, exists, is_dir = await asyncio.to_thread(_probe, current, target)
  
-        # /tmp/commandtest_workspace から外に出ないようにチェック
-        if not (new_dir == BASE_DIR or BASE_DIR in new_dir.parents):
-            return "エラー: 作業ディレクトリの外には移動できません。"
+    # /tmp/commandtest_workspace から外に出ないようにチェック
+    path = str(new_dir)
+    if not (path == _BASE_STR or path.startswith(_BASE_PREFIX)):
+        return "エラー: 作業ディレクトリの外には移動できません。"
  
-        if not new_dir.exists():
-            return f"エラー: ディレクトリが存在しません: {new_dir}"
+    if not exists:
+        return f"エラー: ディレクトリが存在しません: {new_dir}"
  
-        if not new_dir.is_dir():
-            return f"エラー: ディレクトリではありません: {new_dir}"
+    if not is_dir:
+        return f"エラー: ディレクトリではありません: {new_dir}"
  
-        _current_dir = new_dir
-        return f"現在のディレクトリ: {new_dir}"
+    await _set_current_dir(new_dir, session_id)
+    return f"現在のディレクトリ: {new_dir}"
  
  
-def _truncate(s: Optional[str], limit: int) -> str:
-    """UTF-8 バイト数で安全に切り詰める"""
-    if s is None:
-        return ""
-    b = s.encode("utf-8")
-    if len(b) <= limit:
-        return s
-    return b[:limit].decode("utf-8", errors="ignore") + "\n[...省略しました...]"
+# "cd" / "cd <移動先>" を1回のマッチで判定し、移動先を取り出す
+_CD_RE = re.compile(r"cd(?:\s+(?P<target>.*))?", re.DOTALL)
  
  
 # ===== FastAPI 本体 =====
+DOCS_URL = "/commandtest/docs"
+REDOC_URL = "/redoc"  # FastAPI の既定のパス（以前から公開していたので残す）
+OAUTH2_REDIRECT_URL = "/docs/oauth2-redirect"  # 同上
+OPENAPI_URL = "/commandtest/openapi.json"
+ 
+# openapi.json とドキュメントの HTML は root_path が同じなら内容が固定なので、
+# 初回に bytes と ETag を作って使い回す
+_page_cache: Dict[Tuple[str, str], Tuple[bytes, str]] = {}
+ 
 app = FastAPI(
     title="サーバーコマンドシステム",
     description=(
@@ -70,19 +159,116 @@ app = FastAPI(
         "- 作業ディレクトリは /tmp/commandtest_workspace 配下に限定\n"
         "- cd コマンドで現在ディレクトリを移動\n"
         "- それ以外のコマンドは現在ディレクトリ内で実行\n"
+        "- /commandtest/jobs を使うと RQ ワーカー側で実行し、結果を後から取得できる\n"
     ),
-    docs_url="/commandtest/docs",
-    openapi_url="/commandtest/openapi.json",
+    # 既定のルートは使わず、下でキャッシュ付きのルートを登録する
+    docs_url=None,
+    redoc_url=None,
+    openapi_url=None,
+    swagger_ui_oauth2_redirect_url=OAUTH2_REDIRECT_URL,
+    # dict を返すエンドポイントも orjson で直列化する
+    default_response_class=ORJSONResponse,
 )
  
  
+def _cached_page(
+    request: Request,
+    name: str,
+    build: Callable[[str], bytes],
+    media_type: str,
+    cache_control: str,
+) -> Response:
+    """
+    build(root_path) の結果を root_path ごとにキャッシュして返す。
+    ブラウザが同じ ETag を持っていれば 304 を返す。
+    """
+    # FastAPI の既定のルートと同じく、プロキシ配下の root_path を URL に反映する
+    root_path = request.scope.get("root_path", "").rstrip("/")
+    cached = _page_cache.get((name, root_path))
+    if cached is None:
+        body = build(root_path)
+        cached = (body, '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"')
+        _page_cache[(name, root_path)] = cached
+    body, etag = cached
+ 
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type=media_type, headers=headers)
+ 
+ 
+def _openapi_bytes(root_path: str) -> bytes:
+    schema = app.openapi()
+    if root_path:
+        # プロキシ配下では Swagger UI などが root_path 付きの URL に送信できるようにする
+        schema = {**schema, "servers": [{"url": root_path}, *schema.get("servers", [])]}
+    return orjson.dumps(schema)
+ 
+ 
+@app.get(OPENAPI_URL, include_in_schema=False)
+async def openapi_json(request: Request) -> Response:
+    """OpenAPI スキーマ（初回のみ生成・直列化。変わっていなければ 304 を返す）"""
+    # デプロイでスキーマが変わりうるので、毎回 ETag で確認させる
+    return _cached_page(request, "openapi", _openapi_bytes, "application/json", "no-cache")
+ 
+ 
+def _swagger_ui_bytes(root_path: str) -> bytes:
+    # FastAPI の既定の Swagger UI ルートと同じ引数を渡す
+    return get_swagger_ui_html(
+        openapi_url=root_path + OPENAPI_URL,
+        title=f"{app.title} - Swagger UI",
+        oauth2_redirect_url=root_path + OAUTH2_REDIRECT_URL,
+        init_oauth=app.swagger_ui_init_oauth,
+        swagger_ui_parameters=app.swagger_ui_parameters,
+    ).body
+ 
+ 
+@app.get(DOCS_URL, include_in_schema=False)
+async def swagger_ui(request: Request) -> Response:
+    """Swagger UI（ブラウザがキャッシュを持っていれば 304 を返す）"""
+    return _cached_page(
+        request, "docs", _swagger_ui_bytes, "text/html; charset=utf-8", "public, max-age=3600"
+    )
+ 
+ 
+@app.get(OAUTH2_REDIRECT_URL, include_in_schema=False)
+async def swagger_ui_redirect(request: Request) -> Response:
+    """Swagger UI の OAuth2 認可後のリダイレクト先（ブラウザがキャッシュを持っていれば 304 を返す）"""
+    return _cached_page(
+        request,
+        "oauth2-redirect",
+        lambda root_path: get_swagger_ui_oauth2_redirect_html().body,
+        "text/html; charset=utf-8",
+        "public, max-age=3600",
+    )
+ 
+ 
+@app.get(REDOC_URL, include_in_schema=False)
+async def redoc(request: Request) -> Response:
+    """ReDoc（ブラウザがキャッシュを持っていれば 304 を返す）"""
+    return _cached_page(
+        request,
+        "redoc",
+        lambda root_path: get_redoc_html(
+            openapi_url=root_path + OPENAPI_URL, title=f"{app.title} - ReDoc"
+        ).body,
+        "text/html; charset=utf-8",
+        "public, max-age=3600",
+    )
+ 
+ 
 @app.post("/commandtest/run")
 async def run_command(
     command: str = Body(
         ...,
         example="ls",
         description="実行したいLinuxコマンドをそのまま入力（例: ls, mkdir test, rm -r test, cd test）",
-    )
+    ),
+    session_id: Optional[str] = Header(
+        None,
+        alias="X-Session-ID",
+        description="指定すると作業ディレクトリをセッションごとに分けて保持する",
+    ),
 ):
     """
     サーバー上でLinuxコマンドを実行するAPI。
@@ -90,47 +276,31 @@ async def run_command(
     - 1回に1つのコマンドを実行
     - cd のみ特別扱い（カレントディレクトリを変更）
     - それ以外のコマンドは現在の作業ディレクトリ内で実行
+    - X-Session-ID ヘッダがあれば作業ディレクトリはセッションごと
     """
     command = command.strip()
  
     if not command:
-        cwd = get_current_dir()
-        return {
+        cwd = await get_current_dir(session_id)
+        return ORJSONResponse({
             "作業ディレクトリ": str(cwd),
             "エラー": "コマンドが空です。何か入力してください。",
-        }
+        })
  
-    # --- cd 専用処理 ---
-    if command.startswith("cd "):
-        target = command[3:].strip()
-        msg = change_dir(target)
-        return {
-            "作業ディレクトリ": str(get_current_dir()),
+    # --- cd 専用処理（"cd" 単体なら BASE_DIR へ） ---
+    m = _CD_RE.fullmatch(command)
+    if m:
+        msg = await change_dir(m["target"] or "", session_id)
+        return ORJSONResponse({
+            "作業ディレクトリ": str(await get_current_dir(session_id)),
             "結果": msg,
-        }
- 
-    if command == "cd":
-        msg = change_dir("")
-        return {
-            "作業ディレクトリ": str(get_current_dir()),
-            "結果": msg,
-        }
+        })
  
     # --- 通常コマンド ---
-    cwd = get_current_dir()
+    cwd = await get_current_dir(session_id)
  
     try:
-        result = subprocess.run(
-            command,
-            shell=True,
-            text=True,
-            capture_output=True,
-            cwd=str(cwd),
-            timeout=CMD_TIMEOUT,
-        )
- 
-        stdout = _truncate((result.stdout or "").strip(), MAX_BYTES)
-        stderr = _truncate((result.stderr or "").strip(), MAX_BYTES)
+        returncode, stdout, stderr = await run_shell(command, cwd)
  
         if not stdout:
             stdout = "出力なし"
@@ -143,17 +313,101 @@ async def run_command(
         if stderr:
             response["エラー"] = stderr
  
-        response["終了コード"] = result.returncode
+        response["終了コード"] = returncode
  
-        return response
+        return ORJSONResponse(response)
  
-    except subprocess.TimeoutExpired:
-        return {
+    except asyncio.TimeoutError:
+        return ORJSONResponse({
             "作業ディレクトリ": str(cwd),
             "エラー": f"{CMD_TIMEOUT}秒を超えてタイムアウトしました。",
-        }
+        })
     except Exception as e:
-        return {
+        return ORJSONResponse({
             "作業ディレクトリ": str(cwd),
             "エラー": f"実行中に問題が発生しました: {e!r}",
-        }
+        })
+ 
+ 
+# ===== RQ ワーカーでの実行 =====
+# 接続は最初のコマンド送信時に張られる
+_queue = Queue(settings.rq_queue_name, connection=get_redis())
+ 
+ 
+@app.post("/commandtest/jobs")
+async def enqueue_command(
+    command: str = Body(
+        ...,
+        example="ls",
+        description="ワーカーで実行したいLinuxコマンド（cd は使えません）",
+    ),
+    session_id: Optional[str] = Header(
+        None,
+        alias="X-Session-ID",
+        description="指定するとそのセッションの作業ディレクトリで実行する",
+    ),
+):
+    """
+    コマンドを RQ のジョブとして登録するAPI。
+ 
+    - Web プロセスでは実行せず、すぐにジョブIDを返す
+    - 現在の作業ディレクトリで実行される
+    - 結果は /commandtest/jobs/{job_id} で取得
+    """
+    command = command.strip()
+    cwd = await get_current_dir(session_id)
+ 
+    if not command:
+        return ORJSONResponse({
+            "作業ディレクトリ": str(cwd),
+            "エラー": "コマンドが空です。何か入力してください。",
+        })
+ 
+    # ワーカーで cd だけ実行しても作業ディレクトリは変わらないので受け付けない
+    # （"cd sub && ls" のようにシェルで続けて実行するものはそのまま動く）
+    if _CD_RE.fullmatch(command) and not _needs_shell(command):
+        return ORJSONResponse({
+            "作業ディレクトリ": str(cwd),
+            "エラー": "cd はジョブでは使えません。/commandtest/run で実行してください。",
+        })
+ 
+    # RQ は同期 API なのでスレッドで呼び、イベントループを止めない
+    job = await asyncio.to_thread(
+        _queue.enqueue,
+        tasks.run_command, command, str(cwd),
+        job_timeout=settings.rq_job_timeout,
+        result_ttl=settings.rq_result_ttl,
+        failure_ttl=settings.rq_failure_ttl,
+    )
+    return ORJSONResponse({
+        "作業ディレクトリ": str(cwd),
+        "ジョブID": job.id,
+        # enqueue 時に設定された状態を使い、Redis に問い合わせ直さない
+        "状態": job.get_status(refresh=False),
+    })
+ 
+ 
+@app.get("/commandtest/jobs/{job_id}")
+def get_job(job_id: str):
+    """登録したジョブの状態と、終わっていれば実行結果を返すAPI。"""
+    try:
+        job = Job.fetch(job_id, connection=_queue.connection)
+    except NoSuchJobError:
+        return ORJSONResponse({
+            "ジョブID": job_id,
+            "エラー": "ジョブが見つかりません。",
+        })
+ 
+    # 状態は Job.fetch で読み込み済みなので、問い合わせ直さずに1回だけ参照して分岐する
+    status = job.get_status(refresh=False)
+    response = {
+        "ジョブID": job.id,
+        "状態": status,
+    }
+ 
+    if status == JobStatus.FINISHED:
+        response["結果"] = job.return_value()
+    elif status == JobStatus.FAILED:
+        response["エラー"] = "ジョブの実行に失敗しました。"
+ 
+    return ORJSONResponse(response)
@@ -0,0 +1,48 @@
+import redis
+import redis.asyncio
+
+from app.settings import settings
+
+# 接続プールはプロセスごとに1つだけ作り、使い回す
+_POOL_OPTIONS = dict(
+    max_connections=settings.redis_pool_size,
+    socket_keepalive=True,
+    health_check_interval=settings.redis_health_check_interval,
+    # 一時的なネットワーク断で即エラーにせず、1回だけ再送する
+    retry_on_timeout=True,
+)
+
+# API 用（短いコマンドしか送らないので socket_timeout を設定する）
+# 同時リクエストが max_connections を超えたら、エラーにせず空くまで待つ
+pool = redis.BlockingConnectionPool.from_url(
+    settings.redis_url,
+    timeout=settings.redis_pool_timeout,
+    socket_timeout=settings.redis_socket_timeout,
+    **_POOL_OPTIONS,
+)
+async_pool = redis.asyncio.BlockingConnectionPool.from_url(
+    settings.redis_url,
+    timeout=settings.redis_pool_timeout,
+    socket_timeout=settings.redis_socket_timeout,
+    decode_responses=True,
+    **_POOL_OPTIONS,
+)
+
+
+def get_redis() -> redis.Redis:
+    """RQ の Queue / Job 用の同期クライアント"""
+    return redis.Redis(connection_pool=pool)
+
+
+def get_async_redis() -> redis.asyncio.Redis:
+    """セッション情報などを読み書きする非同期クライアント（文字列でやりとり）"""
+    return redis.asyncio.Redis(connection_pool=async_pool)
+
+
+def get_worker_redis() -> redis.Redis:
+    """
+    RQ ワーカー用の同期クライアント。
+    ワーカーは BLPOP で長く待つので socket_timeout は設定せず RQ に任せる
+    （短くするとアイドル中にタイムアウトしてワーカーが終了してしまう）。
+    """
+    return redis.Redis(connection_pool=redis.ConnectionPool.from_url(settings.redis_url, **_POOL_OPTIONS))
@@ -1,13 +1,27 @@
-from pydantic_settings import BaseSettings
+import os
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8", frozen=True)
+
     redis_url: str = "redis://redis:6379/0"
     rq_queue_name: str = "default"
     cmd_timeout: int = 5
     max_bytes: int = 200000
-
-    class Config:
-        env_file = ".env"
+    cmd_cache_ttl: float = 2.0
+    cmd_cache_size: int = 512
+    session_ttl: int = 3600
+    redis_socket_timeout: int = 10
+    redis_pool_size: int = 50
+    redis_pool_timeout: int = 5    # 接続プールが満杯のとき空きを待つ最大秒数
+    redis_health_check_interval: int = 30
+    rq_job_timeout: int = 30       # cmd_timeout より長くしておく
+    rq_result_ttl: int = 500
+    rq_failure_ttl: int = 86400
+    rq_worker_ttl: int = 2000
+    rq_num_workers: int = max(2, os.cpu_count() or 2)
+    rq_pubsub_sleep: float = 2.0   # 長くするほど待機中は軽いが、ワーカー終了時の待ちが最大この秒数延びる
 
 settings = Settings()
 
@@ -1,13 +1,78 @@
+import os
+import selectors
+import shlex
 import subprocess
+import time
+from typing import Optional, Tuple
 
-def run_command(command: str):
+from app._common import (
+    _READ_CHUNK,
+    _append_capped,
+    _decode_output,
+    _kill_group,
+    _needs_shell,
+    _which,
+)
+from app.settings import settings
+
+def _communicate_capped(
+    p: subprocess.Popen, limit: int, timeout: float
+) -> Tuple[Tuple[bytearray, bool], Tuple[bytearray, bool]]:
+    """
+    stdout/stderr を少しずつ読み、それぞれ先頭 limit バイトだけを保持する。
+    - 戻り値はそれぞれ (保持したバイト列, limit を超えて切り捨てたか)（API 側の _read_capped と同じ）
+    - 残りは読み捨てて、子プロセスがパイプ詰まりで止まらないようにする
+    - timeout 秒を超えたら subprocess.TimeoutExpired を送出
+    """
+    deadline = time.monotonic() + timeout
+    bufs = {p.stdout: bytearray(), p.stderr: bytearray()}
+    truncated = {p.stdout: False, p.stderr: False}
+    with selectors.DefaultSelector() as sel:
+        for f in bufs:
+            sel.register(f, selectors.EVENT_READ)
+        while sel.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(p.args, timeout)
+            for key, _ in sel.select(remaining):
+                chunk = os.read(key.fd, _READ_CHUNK)
+                if not chunk:
+                    sel.unregister(key.fileobj)
+                    continue
+                truncated[key.fileobj] |= _append_capped(bufs[key.fileobj], chunk, limit)
+    p.wait(timeout=max(deadline - time.monotonic(), 0))
+    return (bufs[p.stdout], truncated[p.stdout]), (bufs[p.stderr], truncated[p.stderr])
+
+def _popen(command: str, cwd: Optional[str]) -> subprocess.Popen:
+    """
+    サブプロセスを起動する（API 側の _spawn と同じ方針）。
+    - シェルの機能が不要なコマンドは直接 exec し、/bin/sh の起動を省く
+    - タイムアウト時に孫プロセスまで kill できるよう、新しいセッションで起動する
+    """
+    kwargs = dict(stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, start_new_session=True)
+    if not _needs_shell(command):
+        argv = shlex.split(command)
+        try:
+            return subprocess.Popen(argv, executable=_which(argv[0], os.environ.get("PATH")), **kwargs)
+        except (FileNotFoundError, PermissionError):
+            pass
+    return subprocess.Popen(command, shell=True, **kwargs)
+
+def run_command(command: str, cwd: Optional[str] = None):
     """コンテナ内で安全にコマンドを実行"""
     try:
-        result = subprocess.run(
-            command, shell=True, capture_output=True, text=True, timeout=5
-        )
-        return {"stdout": result.stdout, "stderr": result.stderr, "returncode": result.returncode}
+        with _popen(command, cwd) as p:
+            try:
+                stdout, stderr = _communicate_capped(p, settings.max_bytes, timeout=settings.cmd_timeout)
+            except subprocess.TimeoutExpired:
+                _kill_group(p.pid)
+                # 直接 exec した場合も、エラー文には入力どおりのコマンドを出す
+                raise subprocess.TimeoutExpired(command, settings.cmd_timeout) from None
+        return {
+            "stdout": _decode_output(stdout, strip=False),
+            "stderr": _decode_output(stderr, strip=False),
+            "returncode": p.returncode,
+        }
     except Exception as e:
         return {"error": str(e)}
 
-
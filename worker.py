@@ -1,13 +1,45 @@
-from rq import Worker, Queue, Connection
-from redis import Redis
+from rq import Worker
+from rq.worker_pool import WorkerPool
+from app.redis_client import get_worker_redis
 from app.settings import settings
  
+ 
+class CommandWorker(Worker):
+    """
+    このアプリ用の Worker。
+    - settings の TTL を既定値にする（WorkerPool からは TTL を渡せないため）
+    - pub/sub の待ち受け間隔を延ばし、待機中の CPU・Redis への負荷を減らす
+      （停止命令などは届いた時点で処理されるので遅れない。代わりにワーカー終了時の
+      unsubscribe で、pub/sub スレッドの終了を最大 rq_pubsub_sleep 秒待つ）
+    """
+ 
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("default_result_ttl", settings.rq_result_ttl)
+        kwargs.setdefault("default_worker_ttl", settings.rq_worker_ttl)
+        super().__init__(*args, **kwargs)
+ 
+    def subscribe(self):
+        """Worker.subscribe と同じだが、get_message の待ち時間（sleep_time）を 0.2 秒から rq_pubsub_sleep 秒にする"""
+        self.log.info("Subscribing to channel %s", self.pubsub_channel_name)
+        self.pubsub = self.connection.pubsub()
+        self.pubsub.subscribe(**{self.pubsub_channel_name: self.handle_payload})
+        self.pubsub_thread = self.pubsub.run_in_thread(
+            sleep_time=settings.rq_pubsub_sleep, daemon=True
+        )
+ 
+ 
 def main():
-    redis_conn = Redis.from_url(settings.redis_url)
+    redis_conn = get_worker_redis()
     listen = [settings.rq_queue_name]
-    with Connection(redis_conn):
-         worker = Worker(list(map(Queue, listen)))
-         worker.work()
+    # 1つのコンテナ内で rq_num_workers 個のワーカープロセスを起動する
+    pool = WorkerPool(
+        listen,
+        connection=redis_conn,
+        num_workers=settings.rq_num_workers,
+        worker_class=CommandWorker,
+    )
+    pool.start(burst=False, logging_level="INFO")
  
  
 if __name__ == "__main__":
+    main()